@@ -1,9 +1,13 @@
 import argparse
+import asyncio
+import io
 import json
 import os
 import re
 import time
-from typing import Any, Dict, List, Optional
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
 
@@ -13,13 +17,46 @@ PROMPTS_FILE_DEFAULT = os.getenv("EVAL_PROMPTS_FILE", "eval_prompts.json")
 LAT_RE = re.compile(r"\[latency_ms=(\d+)\]")
 
 
+@dataclass(slots=True)
+class PromptResult:
+    id: Any
+    prompt: str
+    ok: bool
+    status: Optional[int]
+    error: str
+    output: str
+    client_elapsed_ms: int
+    server_latency_ms: Optional[int]
+
+    def to_dict(self) -> Dict[str, Any]:
+        # hand-rolled (asdict deep-copies); key order matches the JSON schema
+        return {
+            "id": self.id,
+            "prompt": self.prompt,
+            "ok": self.ok,
+            "status": self.status,
+            "error": self.error,
+            "output": self.output,
+            "client_elapsed_ms": self.client_elapsed_ms,
+            "server_latency_ms": self.server_latency_ms,
+        }
+
+
+def make_client() -> httpx.AsyncClient:
+    # One pooled client for the whole run so every prompt reuses the same
+    # keep-alive connections. HTTP/2 is negotiated over TLS (https API URLs);
+    # plain http:// just stays on persistent HTTP/1.1 connections.
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=httpx.Timeout(None, connect=5.0),
+    )
+
+
 def read_streaming_text(resp: httpx.Response) -> str:
-    # endpoint returns text/plain streamed chunks
-    out_parts: List[str] = []
-    for chunk in resp.iter_text():
-        if chunk:
-            out_parts.append(chunk)
-    return "".join(out_parts)
+    # endpoint streams text/plain; charset=utf-8. The body is already fully
+    # read by aread(), so decode the bytes once instead of chunk by chunk.
+    return resp.content.decode("utf-8", errors="replace")
 
 
 def extract_server_latency_ms(text: str) -> Optional[int]:
@@ -32,6 +69,108 @@ def extract_server_latency_ms(text: str) -> Optional[int]:
         return None
 
 
+async def run_one(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    api_url: str,
+    headers: Dict[str, str],
+    cid: str,
+    idx: int,
+    total: int,
+    p: Dict[str, Any],
+) -> Tuple[str, PromptResult]:
+    """
+    Send one prompt. Returns (transcript text, result row) so the caller can
+    write everything in prompt order once all requests finish.
+    """
+    pid = p.get("id", idx)
+    text = p.get("text", "")
+    tlog = io.StringIO()
+
+    async with sem:
+        print(f"Running prompt {idx}/{total} (id={pid})...")
+        print(f"  Sending: {text!r}")
+
+        payload = {"conversation_id": cid, "user_message": text}
+
+        tlog.write(f"\n\nPROMPT {pid}: {text}\n")
+        tlog.write("BOT:\n")
+
+        # monotonic clock: immune to NTP/wall-clock adjustments mid-run
+        start_ns = time.monotonic_ns()
+
+        try:
+            resp = await client.post(api_url, json=payload, headers=headers)
+            await resp.aread()
+            elapsed_ms = (time.monotonic_ns() - start_ns) // 1_000_000
+
+            if resp.status_code != 200:
+                err_text = (resp.text or "").strip()
+                tlog.write(f"[ERROR status={resp.status_code}] {err_text}\n")
+                tlog.write(f"\n[client_elapsed_ms={elapsed_ms}]\n")
+
+                return tlog.getvalue(), PromptResult(
+                    id=pid,
+                    prompt=text,
+                    ok=False,
+                    status=resp.status_code,
+                    error=err_text,
+                    output="",
+                    client_elapsed_ms=elapsed_ms,
+                    server_latency_ms=None,
+                )
+
+            bot_text = read_streaming_text(resp).strip()
+            server_latency_ms = extract_server_latency_ms(bot_text)
+
+            tlog.write(bot_text + "\n")
+            tlog.write(f"\n[client_elapsed_ms={elapsed_ms}]\n")
+
+            return tlog.getvalue(), PromptResult(
+                id=pid,
+                prompt=text,
+                ok=True,
+                status=200,
+                error="",
+                output=bot_text,
+                client_elapsed_ms=elapsed_ms,
+                server_latency_ms=server_latency_ms,
+            )
+
+        except Exception as ex:
+            elapsed_ms = (time.monotonic_ns() - start_ns) // 1_000_000
+            tlog.write(f"[EXCEPTION] {type(ex).__name__}: {ex}\n")
+            tlog.write(f"\n[client_elapsed_ms={elapsed_ms}]\n")
+
+            return tlog.getvalue(), PromptResult(
+                id=pid,
+                prompt=text,
+                ok=False,
+                status=None,
+                error=f"{type(ex).__name__}: {ex}",
+                output="",
+                client_elapsed_ms=elapsed_ms,
+                server_latency_ms=None,
+            )
+
+
+async def run_all(
+    api_url: str,
+    headers: Dict[str, str],
+    cid: str,
+    prompts: List[Dict[str, Any]],
+    concurrency: int,
+) -> List[Tuple[str, PromptResult]]:
+    sem = asyncio.Semaphore(max(1, concurrency))
+    async with make_client() as client:
+        tasks = [
+            run_one(client, sem, api_url, headers, cid, idx, len(prompts), p)
+            for idx, p in enumerate(prompts, start=1)
+        ]
+        # gather keeps results in prompt order regardless of finish order
+        return await asyncio.gather(*tasks)
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--api-url", default=API_URL_DEFAULT)
@@ -42,6 +181,13 @@ def main():
         choices=[None, "on", "off"],
         help="Optional: sends X-Eval-Mode header (useful if server reads it).",
     )
+    ap.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Prompts in flight at once. Keep 1 when later prompts depend on "
+        "earlier turns (they share one conversation_id).",
+    )
     args = ap.parse_args()
 
     api_url = args.api_url
@@ -59,95 +205,26 @@ def main():
     transcript_path = f"results/transcripts/{cid}.txt"
     results_path = f"results/eval_runs/{cid}.json"
 
-    results: List[Dict[str, Any]] = []
-
     headers: Dict[str, str] = {}
     if args.eval_mode == "on":
         headers["X-Eval-Mode"] = "1"
     elif args.eval_mode == "off":
         headers["X-Eval-Mode"] = "0"
 
-    with open(transcript_path, "w", encoding="utf-8") as tlog:
-        tlog.write(f"=== Evaluation run: {cid} ===\n")
-        tlog.write(f"API: {api_url}\n")
-        if headers:
-            tlog.write(f"Headers: {headers}\n")
-        tlog.write("\n")
-
-        with httpx.Client(timeout=None) as client:
-            for idx, p in enumerate(prompts, start=1):
-                pid = p.get("id", idx)
-                text = p.get("text", "")
-
-                print(f"Running prompt {idx}/{len(prompts)} (id={pid})...")
-                print(f"  Sending: {text!r}")
-
-                payload = {"conversation_id": cid, "user_message": text}
-
-                tlog.write(f"\n\nPROMPT {pid}: {text}\n")
-                tlog.write("BOT:\n")
-
-                start = time.time()
-
-                try:
-                    resp = client.post(api_url, json=payload, headers=headers)
-                    elapsed_ms = int((time.time() - start) * 1000)
-
-                    if resp.status_code != 200:
-                        err_text = (resp.text or "").strip()
-                        tlog.write(f"[ERROR status={resp.status_code}] {err_text}\n")
-                        tlog.write(f"\n[client_elapsed_ms={elapsed_ms}]\n")
-
-                        results.append(
-                            {
-                                "id": pid,
-                                "prompt": text,
-                                "ok": False,
-                                "status": resp.status_code,
-                                "error": err_text,
-                                "output": "",
-                                "client_elapsed_ms": elapsed_ms,
-                                "server_latency_ms": None,
-                            }
-                        )
-                        continue
-
-                    bot_text = read_streaming_text(resp).strip()
-                    server_latency_ms = extract_server_latency_ms(bot_text)
-
-                    tlog.write(bot_text + "\n")
-                    tlog.write(f"\n[client_elapsed_ms={elapsed_ms}]\n")
-
-                    results.append(
-                        {
-                            "id": pid,
-                            "prompt": text,
-                            "ok": True,
-                            "status": 200,
-                            "error": "",
-                            "output": bot_text,
-                            "client_elapsed_ms": elapsed_ms,
-                            "server_latency_ms": server_latency_ms,
-                        }
-                    )
-
-                except Exception as ex:
-                    elapsed_ms = int((time.time() - start) * 1000)
-                    tlog.write(f"[EXCEPTION] {type(ex).__name__}: {ex}\n")
-                    tlog.write(f"\n[client_elapsed_ms={elapsed_ms}]\n")
-
-                    results.append(
-                        {
-                            "id": pid,
-                            "prompt": text,
-                            "ok": False,
-                            "status": None,
-                            "error": f"{type(ex).__name__}: {ex}",
-                            "output": "",
-                            "client_elapsed_ms": elapsed_ms,
-                            "server_latency_ms": None,
-                        }
-                    )
+    outcomes = asyncio.run(run_all(api_url, headers, cid, prompts, args.concurrency))
+    results: List[PromptResult] = [row for _, row in outcomes]
+
+    # header + every prompt's buffered transcript, written in one go
+    tparts: List[str] = [f"=== Evaluation run: {cid} ===\n", f"API: {api_url}\n"]
+    if headers:
+        tparts.append(f"Headers: {headers}\n")
+    tparts.append("\n")
+    tparts.extend(chunk for chunk, _ in outcomes)
+    Path(transcript_path).write_text("".join(tparts), encoding="utf-8")
+
+    ok_count = 0
+    for r in results:
+        ok_count += r.ok
 
     summary = {
         "conversation_id": cid,
@@ -155,14 +232,14 @@ def main():
         "prompts_file": prompts_file,
         "run_ts": time.time(),
         "total_prompts": len(prompts),
-        "successes": sum(1 for r in results if r["ok"]),
-        "failures": sum(1 for r in results if not r["ok"]),
-        "ts_percent": round(100.0 * sum(1 for r in results if r["ok"]) / max(1, len(prompts)), 2),
-        "results": results,
+        "successes": ok_count,
+        "failures": len(results) - ok_count,
+        "ts_percent": round(100.0 * ok_count / max(1, len(prompts)), 2),
+        "results": [r.to_dict() for r in results],
     }
 
-    with open(results_path, "w", encoding="utf-8") as f:
-        json.dump(summary, f, indent=2)
+    # encode once and write once (json.dump issues many small writes)
+    Path(results_path).write_text(json.dumps(summary, indent=2), encoding="utf-8")
 
     print(f"\nDone. Transcript saved to: {transcript_path}")
     print(f"Structured results saved to: {results_path}")
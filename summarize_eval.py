@@ -4,13 +4,61 @@
 import argparse
 import glob
 import json
+import os
 import re
-import statistics
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+# orjson is much faster on big result files; fall back to stdlib if missing
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 LAT_RE = re.compile(r"\[latency_ms=(\d+)\]")
-REFUSAL_GUESS_RE = re.compile(r"\b(can[’']?t|cannot)\s+guess\b", re.I)
-GUESSY_PROMPT_RE = re.compile(r"\b(without tools|no tools|guess)\b", re.I)
+# Guess/refusal checks are plain str.find scans plus the same word-boundary
+# test \b does (alnum or "_"), so no regex runs per row. Callers lowercase
+# each prompt/output once and pass it in; the literals are all lowercase.
+GUESSY_PROMPT_WORDS = ("without tools", "no tools", "guess")
+REFUSAL_PREFIXES = ("can't", "can’t", "cant", "cannot")
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+def _word_hits(text: str, word: str):
+    """Yield start offsets of `word` in `text` that sit on word boundaries."""
+    n = len(word)
+    i = text.find(word)
+    while i != -1:
+        end = i + n
+        if (i == 0 or not _is_word_char(text[i - 1])) and (
+            end == len(text) or not _is_word_char(text[end])
+        ):
+            yield i
+        i = text.find(word, i + 1)
+
+def is_guessy_prompt(prompt_lower: str) -> bool:
+    for w in GUESSY_PROMPT_WORDS:
+        for _ in _word_hits(prompt_lower, w):
+            return True
+    return False
+
+def is_guess_refusal(out_lower: str) -> bool:
+    # "can't|can’t|cant|cannot", 1+ whitespace, then the word "guess"
+    for i in _word_hits(out_lower, "guess"):
+        j = i
+        while j > 0 and out_lower[j - 1].isspace():
+            j -= 1
+        if j == i:
+            continue
+        head = out_lower[:j]
+        for p in REFUSAL_PREFIXES:
+            if head.endswith(p):
+                k = j - len(p)
+                if k == 0 or not _is_word_char(head[k - 1]):
+                    return True
+    return False
 
 def extract_latency_ms(row: dict) -> int | None:
     v = row.get("client_elapsed_ms")
@@ -26,12 +74,12 @@ def extract_latency_ms(row: dict) -> int | None:
     return None
 def pct(x: float) -> str:
     return f"{x:.1f}%"
-def quantile(values: list[int], q: float) -> float | None:
-    if not values:
+def quantile(sorted_values: list[int], q: float) -> float | None:
+    # expects values already sorted so several quantiles share one sort
+    if not sorted_values:
         return None
-    values = sorted(values)
-    idx = int(round((len(values) - 1) * q))
-    return float(values[idx])
+    idx = int(round((len(sorted_values) - 1) * q))
+    return float(sorted_values[idx])
 def infer_eval_mode(data: dict) -> str:
     """
     Best-effort inference:
@@ -56,10 +104,8 @@ def infer_eval_mode(data: dict) -> str:
                     return "off"
     rows = data.get("results", []) or []
     for r in rows:
-        prompt = (r.get("prompt") or "")
-        if GUESSY_PROMPT_RE.search(prompt):
-            out = (r.get("output") or "")
-            if REFUSAL_GUESS_RE.search(out):
+        if is_guessy_prompt((r.get("prompt") or "").lower()):
+            if is_guess_refusal((r.get("output") or "").lower()):
                 return "off (inferred)"
             return "on (inferred)"
     return "unknown"
@@ -72,74 +118,105 @@ def analyze_policy_checks(data: dict) -> list[str]:
     notes: list[str] = []
     rows = data.get("results", []) or []
 
+    # One pass: connection failures + guess prompts and how many were refused
+    conn_fail = 0
+    guess_rows = 0
+    refused = 0
+    for r in rows:
+        if (r.get("ok") is False) and "connection refused" in (r.get("error") or "").lower():
+            conn_fail += 1
+        if is_guessy_prompt((r.get("prompt") or "").lower()):
+            guess_rows += 1
+            if is_guess_refusal((r.get("output") or "").lower()):
+                refused += 1
+
     # Connection refused 
-    conn_fail = [r for r in rows if (r.get("ok") is False) and "connection refused" in (r.get("error") or "").lower()]
     if conn_fail:
-        notes.append(f"Network issue: {len(conn_fail)} requests failed with connection refused (server likely not running).")
+        notes.append(f"Network issue: {conn_fail} requests failed with connection refused (server likely not running).")
 
     # Guess refusal behavior
-    guess_rows = [r for r in rows if GUESSY_PROMPT_RE.search(r.get("prompt") or "")]
     if guess_rows:
-        refused = [r for r in guess_rows if REFUSAL_GUESS_RE.search(r.get("output") or "")]
-        if len(refused) == len(guess_rows):
+        if refused == guess_rows:
             notes.append("Guess/without-tools prompts: refusal behavior ✅")
-        elif len(refused) == 0:
+        elif refused == 0:
             notes.append("Guess/without-tools prompts: refusal behavior ❌ (it answered instead of refusing)")
         else:
-            notes.append(f"Guess/without-tools prompts: partial refusal ({len(refused)}/{len(guess_rows)}).")
+            notes.append(f"Guess/without-tools prompts: partial refusal ({refused}/{guess_rows}).")
 
     return notes
 
-def summarize(path: str) -> None:
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+def summarize(path: str) -> str:
+    """
+    Build the printable report for one eval file. Returned rather than
+    printed so several files can be summarized in parallel.
+    """
+    data = _loads(Path(path).read_bytes())
+    lines: list[str] = []
+
+    def emit(*parts) -> None:
+        # same formatting as print(*parts)
+        lines.append(" ".join(str(x) for x in parts))
 
     rows = data.get("results", [])
-    ok = [r for r in rows if r.get("ok") is True]
-    fail = [r for r in rows if not r.get("ok")]
+    # one pass; a truthy-but-not-True "ok" counts as neither, as before
+    ok: list[dict] = []
+    fail: list[dict] = []
+    for r in rows:
+        v = r.get("ok")
+        if v is True:
+            ok.append(r)
+        elif not v:
+            fail.append(r)
 
     latencies = [extract_latency_ms(r) for r in ok]
-    latencies = [x for x in latencies if isinstance(x, int)]
-
-    avg = round(statistics.mean(latencies), 2) if latencies else None
+    latencies = sorted(x for x in latencies if isinstance(x, int))
+
+    avg = None
+    if latencies:
+        # same result as statistics.mean on ints: exact int when it divides
+        # evenly, otherwise the correctly-rounded float
+        lat_sum, lat_n = sum(latencies), len(latencies)
+        avg = round(lat_sum // lat_n if lat_sum % lat_n == 0 else lat_sum / lat_n, 2)
     p50 = round(quantile(latencies, 0.50), 2) if latencies else None
     p95 = round(quantile(latencies, 0.95), 2) if latencies else None
-    mx = max(latencies) if latencies else None
+    mx = latencies[-1] if latencies else None
 
     total = data.get("total_prompts", len(rows))
     success_rate = (len(ok) / total * 100.0) if total else 0.0
 
     eval_mode = infer_eval_mode(data)
 
-    print("=" * 72)
-    print("File:", path)
-    print("Conversation:", data.get("conversation_id"))
-    print("Eval mode:", eval_mode)
-    print("API URL:", data.get("api_url", ""))
-    print("Total prompts:", total)
-    print("Successes:", len(ok))
-    print("Failures:", len(fail))
-    print("Success rate:", pct(success_rate))
+    emit("=" * 72)
+    emit("File:", path)
+    emit("Conversation:", data.get("conversation_id"))
+    emit("Eval mode:", eval_mode)
+    emit("API URL:", data.get("api_url", ""))
+    emit("Total prompts:", total)
+    emit("Successes:", len(ok))
+    emit("Failures:", len(fail))
+    emit("Success rate:", pct(success_rate))
     if "ts_percent" in data:
-        print("TS%:", data.get("ts_percent"))
+        emit("TS%:", data.get("ts_percent"))
 
-    print("Latency (ms): avg =", avg, "| p50 =", p50, "| p95 =", p95, "| max =", mx)
+    emit("Latency (ms): avg =", avg, "| p50 =", p50, "| p95 =", p95, "| max =", mx)
 
     notes = analyze_policy_checks(data)
     if notes:
-        print("\nNotes:")
+        emit("\nNotes:")
         for n in notes:
-            print("-", n)
+            emit("-", n)
 
     if fail:
-        print("\nFailed prompt IDs:")
+        emit("\nFailed prompt IDs:")
         for r in fail:
             rid = r.get("id")
             st = r.get("status")
             err = (r.get("error") or "").strip()
             if len(err) > 160:
                 err = err[:160] + "…"
-            print(f"- {rid} | status: {st} | error: {err}")
+            emit(f"- {rid} | status: {st} | error: {err}")
+
+    return "\n".join(lines)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -150,17 +227,25 @@ def main():
     )
     args = ap.parse_args()
 
-    files: list[str] = []
+    files: set[Path] = set()
     for p in args.paths:
-        matches = glob.glob(p)
+        # only expand real patterns; plain paths are taken as-is
+        matches = [Path(m) for m in glob.iglob(p)] if any(c in p for c in "*?[") else []
         if matches:
-            files.extend(matches)
+            files.update(matches)
         else:
-            files.append(p)
-
-    files = [str(Path(f)) for f in files]
-    for f in sorted(set(files)):
-        summarize(f)
+            files.add(Path(p))
+
+    # sort by string so the order matches the old sorted(set(str)) output
+    paths = [str(f) for f in sorted(files, key=str)]
+    if len(paths) == 1:
+        print(summarize(paths[0]))
+        return
+
+    # map() yields in submission order, so output stays deterministic
+    with ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as ex:
+        for report in ex.map(summarize, paths):
+            print(report)
 
 if __name__ == "__main__":
     main()
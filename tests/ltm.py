@@ -1,51 +1,60 @@
 # ltm.py
+import functools
+import itertools
 import os
 import time
+import uuid
 from typing import Dict, List
 
-import chromadb
-from chromadb.config import Settings
-
 DEFAULT_DIR = os.getenv("LTM_DIR", "results/ltm_db")
 COLLECTION_NAME = os.getenv("LTM_COLLECTION", "chatbot_ltm")
 
-# lazy singleton
-_client = None
-_collection = None
-
+# doc ids: per-process token + monotonic counter, so two adds in the same
+# millisecond (or from two processes sharing the db) never reuse an id
+_RUN_TOKEN = uuid.uuid4().hex[:8]
+_idctr = itertools.count().__next__
 
-def _get_collection():
-    global _client, _collection
-    if _collection is not None:
-        return _collection
+@functools.cache
+def _collection():
+    # cached after the first call, so the directory is created (and Chroma
+    # started) only once, and not at import time
+    import chromadb
+    from chromadb.config import Settings
 
     os.makedirs(DEFAULT_DIR, exist_ok=True)
 
-    _client = chromadb.PersistentClient(
+    client = chromadb.PersistentClient(
         path=DEFAULT_DIR,
         settings=Settings(anonymized_telemetry=False),
     )
-    _collection = _client.get_or_create_collection(
+    return client.get_or_create_collection(
         name=COLLECTION_NAME,
         metadata={"hnsw:space": "cosine"},
     )
-    return _collection
 
 
 def add_fact(conversation_id: str, fact: str) -> None:
     """
     Store a fact for a conversation_id.
     """
-    fact = (fact or "").strip()
-    if not fact:
+    add_facts(conversation_id, [fact])
+
+
+def add_facts(conversation_id: str, facts: List[str]) -> None:
+    """
+    Store several facts for a conversation_id with a single col.add,
+    so Chroma embeds them as one batch.
+    """
+    docs = [f.strip() for f in facts if f and f.strip()]
+    if not docs:
         return
 
-    col = _get_collection()
-    doc_id = f"{conversation_id}-{int(time.time() * 1000)}"
+    col = _collection()
+    ts = time.time()  # one timestamp for the whole batch
     col.add(
-        ids=[doc_id],
-        documents=[fact],
-        metadatas=[{"conversation_id": conversation_id, "ts": time.time()}],
+        ids=[f"{conversation_id}-{_RUN_TOKEN}-{_idctr()}" for _ in docs],
+        documents=docs,
+        metadatas=[{"conversation_id": conversation_id, "ts": ts} for _ in docs],
     )
 
 
@@ -57,20 +66,18 @@ def search_facts(conversation_id: str, query: str, k: int = 3) -> List[str]:
     if not query:
         return []
 
-    col = _get_collection()
+    # positive ints (the normal case) skip the coercion; anything else is
+    # normalized exactly as before
+    n = k if isinstance(k, int) and k > 0 else max(1, int(k))
+
+    col = _collection()
     res = col.query(
         query_texts=[query],
-        n_results=max(1, int(k)),
+        n_results=n,
         where={"conversation_id": conversation_id},
     )
 
     docs = (res.get("documents") or [[]])[0]
-    # basic cleanup + de-dupe preserving order
-    out: List[str] = []
-    seen = set()
-    for d in docs:
-        d = (d or "").strip()
-        if d and d not in seen:
-            out.append(d)
-            seen.add(d)
-    return out
+    # facts are stripped by add_facts, so just drop empties and de-dupe
+    # (dict.fromkeys keeps first-seen order)
+    return list(dict.fromkeys(d for d in docs if d))
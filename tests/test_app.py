@@ -1,24 +1,259 @@
 # tests/test_app.py
+import asyncio
 import json
+import os
+from types import SimpleNamespace
 
+import httpx
 import pytest
-from app import app, calculate_grade, kb_search
+import app as app_module
+from app import app, calculate_grade, choose_forced_tool, get_weather, guard_check, kb_search
 from fastapi.testclient import TestClient
 
 client = TestClient(app)
 
 
+def test_index_served_gzipped_when_accepted():
+    r = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip"
+    assert "GPT Chatbot" in r.text
+
+    r = client.get("/", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in r.headers
+    assert "GPT Chatbot" in r.text
+
+
 def test_kb_search_grading():
     result = kb_search("grading")
     assert "results" in result
     assert any("Projects" in v for v in result["results"].values())
 
 
+def test_kb_search_nul_in_query_matches_nothing():
+    # "\0" is the section separator in the search corpus
+    assert kb_search("\0")["results"] == {"note": "no match"}
+    assert kb_search("ro\0om 301")["results"] == {"note": "no match"}
+
+
+def test_kb_search_reloads_when_file_changes(tmp_path, monkeypatch):
+    kb = tmp_path / "kb.md"
+    kb.write_text("## Office Hours\n\nMon 1-2pm\n", encoding="utf-8")
+    monkeypatch.setattr(app_module, "KB_PATH", str(kb))
+    monkeypatch.setattr(app_module, "_KB_CACHE", None)
+
+    assert kb_search("office hours")["results"] == {"Office Hours": "Mon 1-2pm"}
+
+    kb.write_text("## Office Hours\n\nFri 3-5pm\n", encoding="utf-8")
+    st = kb.stat()
+    os.utime(kb, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert kb_search("office hours")["results"] == {"Office Hours": "Fri 3-5pm"}
+
+
 def test_calculate_grade():
     result = calculate_grade(90, 90, 90)
     assert result["final_percentage"] == 90.0
 
 
+def test_calculate_grade_clamps_inputs():
+    result = calculate_grade(120, -5, "50")
+    assert result["inputs"] == {"project": 100.0, "exams": 0.0, "participation": 50.0}
+    assert result["final_percentage"] == 65.0
+
+    # NaN clamps to 100 rather than leaking into the result
+    result = calculate_grade("NaN", 80, 90)
+    assert result["inputs"]["project"] == 100.0
+    assert result["final_percentage"] == 93.0
+
+
+@pytest.mark.parametrize("text, tool", [
+    ("What is the weather like in Miami right now?", "get_weather"),
+    ("What are our office hours?", "kb_search"),
+    ("My projects average is 85, exams average is 72, participation is 100.", "calculate_grade"),
+    ("Who is the current president of the United States of America?", "web_lookup"),
+    ("Remember that my name is Sam.", None),
+    ("Guess the office hours without tools.", None),
+])
+def test_choose_forced_tool(text, tool):
+    assert choose_forced_tool(text) == tool
+
+
+def test_weather_caches_geocoding(monkeypatch):
+    calls = []
+
+    def handler(req: httpx.Request) -> httpx.Response:
+        calls.append(req.url.host)
+        if "geocoding" in req.url.host:
+            return httpx.Response(200, json={"results": [{"latitude": 1.0, "longitude": 2.0}]})
+        return httpx.Response(200, json={"current": {"temperature_2m": 20, "wind_speed_10m": 5}})
+
+    monkeypatch.setattr(app_module, "_http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(app_module, "_GEO_CACHE", app_module.OrderedDict())
+    monkeypatch.setattr(app_module, "_GEO_CACHE_MAX", 2)
+
+    r1 = asyncio.run(get_weather("Reno"))
+    r2 = asyncio.run(get_weather(" reno "))
+    assert r1["temperature_c"] == 20
+    assert r2["wind_speed_kph"] == 5
+    assert sum("geocoding" in h for h in calls) == 1
+
+    # least recently used city is evicted once the cap is hit
+    asyncio.run(get_weather("Boise"))
+    asyncio.run(get_weather("Reno"))
+    asyncio.run(get_weather("Elko"))
+    assert list(app_module._GEO_CACHE) == ["reno", "elko"]
+
+
+def test_rate_limit_sliding_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app_module.time, "time", lambda: now[0])
+    monkeypatch.setattr(app_module, "RATE_LIMIT_RPM", 2)
+    monkeypatch.setattr(app_module, "RATE", {})
+
+    app_module.rate_limit("1.2.3.4")
+    app_module.rate_limit("1.2.3.4")
+    with pytest.raises(app_module.HTTPException):
+        app_module.rate_limit("1.2.3.4")
+
+    now[0] += 60
+    app_module.rate_limit("1.2.3.4")
+
+
+def test_conversation_memory_is_bounded(monkeypatch):
+    monkeypatch.setattr(app_module, "MEMORY_WINDOW", 2)
+    monkeypatch.setattr(app_module, "MAX_CONVERSATIONS", 2)
+    monkeypatch.setattr(app_module, "CONV", app_module.OrderedDict())
+
+    for i in range(3):
+        app_module.append_msg("a", "user", f"msg {i}")
+    app_module.append_msg("b", "user", "hi")
+    app_module.append_msg("a", "user", "again")
+    app_module.append_msg("c", "user", "hello")
+
+    msgs = app_module.convo_messages("a")
+    assert [m["content"] for m in msgs[1:]] == ["msg 2", "again"]
+    assert list(app_module.CONV) == ["a", "c"]
+
+
+def test_metrics_writer_flushes_on_stop(tmp_path, monkeypatch):
+    path = tmp_path / "metrics.jsonl"
+    monkeypatch.setattr(app_module, "METRICS_PATH", str(path))
+
+    async def run():
+        await app_module.start_metrics_writer()
+        app_module.log_metrics({"n": 1})
+        app_module.log_metrics({"n": 2})
+        await app_module.stop_metrics_writer()
+
+    asyncio.run(run())
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(ln)["n"] for ln in lines] == [1, 2]
+
+
+def test_metrics_writer_survives_bad_record(tmp_path, monkeypatch):
+    path = tmp_path / "metrics.jsonl"
+    monkeypatch.setattr(app_module, "METRICS_PATH", str(path))
+
+    async def run():
+        await app_module.start_metrics_writer()
+        app_module.log_metrics({"n": 1})
+        app_module.log_metrics({"n": object()})  # orjson can't encode this
+        await asyncio.sleep(0)
+        app_module.log_metrics({"n": 2})
+        await app_module.stop_metrics_writer()
+
+    asyncio.run(run())
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(ln)["n"] for ln in lines] == [1, 2]
+
+
+def test_metrics_writer_bad_path_fails_at_startup(tmp_path, monkeypatch):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_text("")
+    monkeypatch.setattr(app_module, "METRICS_PATH", str(blocker / "metrics.jsonl"))
+
+    with pytest.raises(OSError):
+        asyncio.run(app_module.start_metrics_writer())
+    assert app_module._metrics_task is None
+
+
+class FakeCompletions:
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    async def create(self, stream=False, **kwargs):
+        if stream:
+            return self._stream()
+        msg = SimpleNamespace(content="", tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=msg)], usage=None)
+
+    async def _stream(self):
+        for p in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=p))])
+
+
+def test_chat_streams_answer_from_async_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "METRICS_PATH", str(tmp_path / "metrics.jsonl"))
+    fake = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(["Hel", "lo", "!"])))
+    monkeypatch.setattr(app_module, "get_aclient", lambda: fake)
+
+    r = client.post("/chat", json={"conversation_id": "test_stream", "user_message": "Say hello"})
+    assert r.status_code == 200
+    assert r.text.startswith("Hello!")
+    assert "[latency_ms=" in r.text
+
+
+def test_president_lookup_parses_usagov(monkeypatch):
+    html = (
+        "<p>The current president of the United States is Jane Q. Doe. "
+        "She was sworn into office on January 20, 2025.</p>"
+    )
+    transport = httpx.MockTransport(lambda req: httpx.Response(200, text=html))
+    monkeypatch.setattr(app_module, "_http", httpx.AsyncClient(transport=transport))
+
+    result = asyncio.run(app_module._lookup_us_president_via_usagov())
+    assert result["answer"] == (
+        "The current president of the United States is Jane Q. Doe. Sworn into office on January 20, 2025."
+    )
+
+
+def test_web_lookup_is_cached_and_deduped(monkeypatch):
+    calls = []
+
+    def handler(req: httpx.Request) -> httpx.Response:
+        calls.append(req.url.params["q"])
+        return httpx.Response(200, json={"Answer": "Carson City"})
+
+    monkeypatch.setattr(app_module, "_http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(app_module, "_WEB_CACHE", app_module.OrderedDict())
+
+    async def run():
+        both = await asyncio.gather(
+            app_module.web_lookup("capital of Nevada"),
+            app_module.web_lookup("Capital of  nevada"),
+        )
+        again = await app_module.web_lookup("capital of nevada")
+        return both + [again]
+
+    results = asyncio.run(run())
+    assert [r["answer"] for r in results] == ["Carson City"] * 3
+    assert len(calls) == 1
+
+
+def test_coalesce_stream_batches_tokens():
+    async def pieces():
+        for p in ["a", "b", "c"]:
+            yield p
+        await asyncio.sleep(0.1)
+        yield "d" * 10
+        yield "e"
+
+    async def run():
+        return [c async for c in app_module.coalesce_stream(pieces(), max_chars=8, max_delay=0.02)]
+
+    assert asyncio.run(run()) == ["abc", "dddddddddd", "e"]
+
+
 def test_memory_persists_between_turns():
     cid = "test_memory"
 
@@ -45,6 +280,23 @@ def test_bomb_refusal():
     assert "can't assist" in r.text.lower()
 
 
+@pytest.mark.parametrize("text, guard", [
+    ("how to make a bomb", "unsafe"),
+    ("how to make a bomb, I want to end my life", "harm"),
+    ("guess my key sk-THISISFAKE1234567890", "secret"),
+    ("Guess the office hours", "notools"),
+    ("What are our office hours?", None),
+    # re.I case folding the str.lower() prefilter would miss
+    ("I think about ſuicide a lot", "harm"),
+    ("SUİCIDE", "harm"),
+    ("kill myſelf", "harm"),
+    ("how to build an exploſive device", "unsafe"),
+    ("Café hours?", None),
+])
+def test_guard_check_priority(text, guard):
+    assert guard_check(text) == guard
+
+
 def test_secret_redaction():
     r = client.post("/chat", json={
         "conversation_id": "test_secret",
@@ -0,0 +1,34 @@
+# tests/test_summarize_eval.py
+import pytest
+from summarize_eval import is_guess_refusal, is_guessy_prompt
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("I can’t guess that.", True),
+    ("I can't guess.", True),
+    ("I cant  guess", True),
+    ("Sorry, I cannot\tguess without tools.", True),
+    ("I CAN'T\nGUESS", True),
+    ("I can'tguess", False),
+    ("scan't guess", False),
+    ("I can't guesses", False),
+    ("can't _guess", False),
+    ("I can guess", False),
+    ("", False),
+])
+def test_is_guess_refusal(text, expected):
+    assert is_guess_refusal(text.lower()) is expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Guess the office hours.", True),
+    ("Answer without tools.", True),
+    ("No tools please", True),
+    ("guesses", False),
+    ("_guess", False),
+    ("piano tools", False),
+    ("no  tools", False),
+    ("What are the office hours?", False),
+])
+def test_is_guessy_prompt(text, expected):
+    assert is_guessy_prompt(text.lower()) is expected